@@ -21,24 +21,29 @@
 ##    SOFTWARE.
 
 import argparse
+import atexit
 import base64
 import binascii
+import concurrent.futures
+import contextlib
 import csv
+import email.message
 import email.utils
 import glob
+import gzip
 import hashlib
 import importlib.util as imputil
-import io
 import json
 import os
 import os.path
 import re
+import shutil
 import subprocess
 import sys
 import tempfile
 import urllib.request
 import zipfile
-from typing import Iterator, List, MutableMapping, Optional, Tuple
+from typing import Iterator, List, MutableMapping, Optional, Set, Tuple
 
 try:
     import winreg
@@ -51,6 +56,21 @@ try:
 except ImportError:
     pass
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    pass
+
+try:
+    import urllib3  # type: ignore
+except ImportError:
+    pass
+
+try:
+    import py7zr  # type: ignore
+except ImportError:
+    pass
+
 bundled_api3_plugins = ['com.vapoursynth.avisource', 'com.vapoursynth.eedi3', 'com.vapoursynth.imwri', 'com.vapoursynth.misc', 'com.vapoursynth.morpho', 'com.vapoursynth.removegrainvs', 'com.vapoursynth.subtext', 'com.vapoursynth.vinverse', 'org.ivtc.v', 'com.nodame.histogram']
 
 
@@ -144,9 +164,11 @@ parser.add_argument('-d', action='store_true', dest='skip_deps', help='skip inst
 parser.add_argument('-t', choices=['win32', 'win64'], default='win64' if is_64bits else 'win32', dest='target', help='binaries to install, defaults to python\'s architecture')
 parser.add_argument('-b', dest='binary_path', help='custom binary install path')
 parser.add_argument('-s', dest='script_path', help='custom script install path')
+parser.add_argument('--verify', action='store_true', dest='verify', help='detect installed packages by hashing their files instead of using the state saved by the last run')
 args = parser.parse_args()
 
 is_64bits = args.target == 'win64'
+plugin_bin_name: str = 'win64' if is_64bits else 'win32'
 
 file_dirname: str = os.path.dirname(os.path.abspath(__file__))
 
@@ -201,6 +223,9 @@ os.makedirs(py_script_path, exist_ok=True)
 os.makedirs(plugin_path, exist_ok=True)
 os.makedirs(os.path.dirname(package_json_path), exist_ok=True)
 
+# absolute install paths ending in a separator so file paths can be built by plain concatenation when probing installed files
+install_path_prefixes = { 'PyScript': os.path.join(os.path.abspath(py_script_path), ''), 'VSPlugin': os.path.join(os.path.abspath(plugin_path), '') }
+
 
 cmd7zip_path: str = os.path.join(file_dirname, '7z.exe')
 if not os.path.isfile(cmd7zip_path):
@@ -211,38 +236,72 @@ if not os.path.isfile(cmd7zip_path):
         cmd7zip_path = '7z.exe'
 
 installed_packages: MutableMapping = {}
-download_cache: MutableMapping = {}
-
-def fetch_ur1(url: str, desc: Optional[str] = None) -> bytearray:
-    with urllib.request.urlopen(url) as urlreq:
-        if ('tqdm' in sys.modules) and (urlreq.headers['content-length'] is not None):
-            size = int(urlreq.headers['content-length'])
-            remaining = size
-            data = bytearray()
-            with tqdm.tqdm(total=size, unit='B', unit_scale=True, unit_divisor=1024, desc=desc) as t:
-                while remaining > 0:
-                    blocksize = min(remaining, 1024*128)
-                    data.extend(urlreq.read(blocksize))
-                    remaining = remaining - blocksize
-                    t.update(blocksize)
-            return data
-        else:
-            print('Fetching: ' + url)
-            return urlreq.read()
 
-def fetch_url_cached(url: str, desc: str = "") -> bytearray:
-    data = download_cache.get(url, None)
-    if data is None:
-        data = fetch_ur1(url, desc)
-        download_cache[url] = data
-    return data
+# keeps connections alive between downloads from the same host when urllib3 is available
+http_pool = urllib3.PoolManager(maxsize=4) if 'urllib3' in sys.modules else None
+
+def copy_response(urlreq, outfile, url: str, desc: Optional[str] = None) -> None:
+    if ('tqdm' in sys.modules) and (urlreq.headers.get('content-length') is not None):
+        size = int(urlreq.headers['content-length'])
+        remaining = size
+        with tqdm.tqdm(total=size, unit='B', unit_scale=True, unit_divisor=1024, desc=desc) as t:
+            while remaining > 0:
+                blocksize = min(remaining, 1024*128)
+                outfile.write(urlreq.read(blocksize))
+                remaining = remaining - blocksize
+                t.update(blocksize)
+    else:
+        print('Fetching: ' + url)
+        shutil.copyfileobj(urlreq, outfile)
+
+def fetch_ur1(url: str, outfile, desc: Optional[str] = None) -> None:
+    if http_pool is None:
+        with urllib.request.urlopen(url) as urlreq:
+            copy_response(urlreq, outfile, url, desc)
+        return
+
+    urlreq = http_pool.request('GET', url, preload_content=False)
+    try:
+        if urlreq.status >= 400:
+            headers = email.message.Message()
+            for key, value in urlreq.headers.items():
+                headers[key] = value
+            raise urllib.error.HTTPError(url, urlreq.status, urlreq.reason or '', headers, None)
+        copy_response(urlreq, outfile, url, desc)
+    except:
+        urlreq.close()
+        raise
+    # only a fully read response may hand its connection back to the pool
+    urlreq.release_conn()
+
+# downloads are kept until the run ends since several packages can share one archive
+download_dir: Optional[str] = None
+downloaded_files: MutableMapping = {}
+
+def fetch_url_cached(url: str, desc: str = "") -> str:
+    global download_dir
+    path = downloaded_files.get(url)
+    if path is None:
+        if download_dir is None:
+            download_dir = tempfile.mkdtemp(prefix='vsm')
+            atexit.register(shutil.rmtree, download_dir, ignore_errors=True)
+        path = os.path.join(download_dir, hashlib.sha1(url.encode('utf-8')).hexdigest())
+        try:
+            with open(path, 'wb') as outfile:
+                fetch_ur1(url, outfile, desc)
+        except:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        downloaded_files[url] = path
+    return path
 
 package_print_string = "{:25s} {:15s} {:11s} {:11s} {:s}"
 
 package_list: Optional[MutableMapping] = None
 try:
-    with open(package_json_path, 'r', encoding='utf-8') as pl:
-        package_list = json.load(pl)
+    with open(package_json_path, 'rb') as pl:
+        package_list = orjson.loads(pl.read()) if 'orjson' in sys.modules else json.loads(pl.read())
     if package_list is None:
         raise ValueError()
     if package_list['file-format'] != 3:
@@ -252,20 +311,90 @@ try:
 except (OSError, FileExistsError, ValueError):
     pass
 
+packages_by_id: MutableMapping = {}
+packages_by_name: MutableMapping = {}
+packages_by_namespace: MutableMapping = {}
+packages_by_modulename: MutableMapping = {}
+package_releases_by_version: MutableMapping = {}
+
+def build_package_indexes() -> None:
+    if package_list is None:
+        return
+    # setdefault keeps the first match, same as the previous linear scans did
+    for p in package_list:
+        packages_by_id.setdefault(p['identifier'], p)
+        packages_by_name.setdefault(p['name'].casefold(), p)
+        if 'namespace' in p:
+            packages_by_namespace.setdefault(p['namespace'], p)
+        if 'modulename' in p:
+            packages_by_modulename.setdefault(p['modulename'], p)
+        if p['identifier'] not in package_releases_by_version:
+            package_releases_by_version[p['identifier']] = {rel['version']: rel for rel in reversed(p['releases']) if isinstance(rel, MutableMapping)}
+
+build_package_indexes()
+
+hash_cache_path = os.path.join(os.path.dirname(package_json_path), 'vsrepo_hashcache.json')
+
+# maps an absolute file path to [size, mtime_ns, sha256] so unchanged files don't have to be hashed again on every run
+hash_cache: MutableMapping = {}
+hash_cache_modified: bool = False
+# paths looked up during this run, anything else belongs to files that are gone or no longer probed
+hash_cache_used: Set[str] = set()
+try:
+    with open(hash_cache_path, 'r', encoding='utf-8') as hc:
+        hash_cache = json.load(hc)
+    if not isinstance(hash_cache, dict):
+        hash_cache = {}
+except (OSError, ValueError):
+    pass
+
+def save_hash_cache() -> None:
+    # nothing was probed, so there's nothing to tell which entries are stale
+    if not hash_cache_used:
+        return
+    kept = {path: hash_cache[path] for path in hash_cache_used if path in hash_cache}
+    if not hash_cache_modified and len(kept) == len(hash_cache):
+        return
+    try:
+        with open(hash_cache_path, 'w', encoding='utf-8') as hc:
+            json.dump(kept, hc)
+    except OSError:
+        pass
+
+atexit.register(save_hash_cache)
+
 def check_hash(data: bytes, ref_hash: str) -> Tuple[bool, str, str]:
     data_hash = hashlib.sha256(data).hexdigest()
     return (data_hash == ref_hash, data_hash, ref_hash)
 
+def hash_file(path: str) -> str:
+    with open(path, 'rb') as fh:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(fh, 'sha256').hexdigest()
+        h = hashlib.sha256()
+        for block in iter(lambda: fh.read(1024*1024), b''):
+            h.update(block)
+        return h.hexdigest()
+
+def get_file_hash(path: str) -> str:
+    global hash_cache_modified
+    hash_cache_used.add(path)
+    st = os.stat(path)
+    entry = hash_cache.get(path)
+    if isinstance(entry, list) and (len(entry) == 3) and (entry[0] == st.st_size) and (entry[1] == st.st_mtime_ns):
+        return entry[2]
+    file_hash = hash_file(path)
+    hash_cache[path] = [st.st_size, st.st_mtime_ns, file_hash]
+    hash_cache_modified = True
+    return file_hash
+
 def get_bin_name(p: MutableMapping):
     if p['type'] == 'PyScript':
         return 'script'
     if p['type'] == 'PyWheel':
         return 'wheel'
     elif p['type'] == 'VSPlugin':
-        if is_64bits:
-            return 'win64'
-        else:
-            return 'win32'
+        return plugin_bin_name
     else:
         raise ValueError('Unknown install type')
 
@@ -280,46 +409,41 @@ def get_install_path(p: MutableMapping) -> str:
 def get_package_from_id(id: str, required: bool = False) -> Optional[MutableMapping]:
     if package_list is None:
         return None
-    for p in package_list:
-        if p['identifier'] == id:
-            return p
-    if required:
+    p = packages_by_id.get(id)
+    if p is None and required:
         raise ValueError(f'No package with the identifier {id} found')
-    return None
+    return p
 
 def get_package_from_plugin_name(name: str, required: bool = False) -> Optional[MutableMapping]:
     if package_list is None:
         return None
-    for p in package_list:
-        if p['name'].casefold() == name.casefold():
-            return p
-    if required:
+    p = packages_by_name.get(name.casefold())
+    if p is None and required:
         raise ValueError(f'No package with the name {name} found')
-    return None
+    return p
 
 def get_package_from_namespace(namespace: str, required: bool = False) -> Optional[MutableMapping]:
     if package_list is None:
         return None
-    for p in package_list:
-        if 'namespace' in p:
-            if p['namespace'] == namespace:
-                return p
-    if required:
+    p = packages_by_namespace.get(namespace)
+    if p is None and required:
         raise ValueError(f'No package with the namespace {namespace} found')
-    return None
+    return p
 
 def get_package_from_modulename(modulename: str, required: bool = False) -> Optional[MutableMapping]:
     if package_list is None:
         return None
-    for p in package_list:
-        if 'modulename' in p:
-            if p['modulename'] == modulename:
-                return p
-    if required:
+    p = packages_by_modulename.get(modulename)
+    if p is None and required:
         raise ValueError(f'No package with the modulename {modulename} found')
-    return None
+    return p
+
+resolved_names: MutableMapping = {}
 
 def get_package_from_name(name: str) -> MutableMapping:
+    p = resolved_names.get(name)
+    if p is not None:
+        return p
     p = get_package_from_id(name)
     if p is None:
         p = get_package_from_namespace(name)
@@ -329,6 +453,7 @@ def get_package_from_name(name: str) -> MutableMapping:
         p = get_package_from_plugin_name(name)
     if p is None:
         raise ValueError(f'Package {name} not found')
+    resolved_names[name] = p
     return p
 
 def is_package_installed(id: str) -> bool:
@@ -339,10 +464,12 @@ def is_package_upgradable(id: str, force: bool) -> bool:
     if pkg is None:
         return False
     lastest_installable = get_latest_installable_release(pkg)
-    if force:
-        return (is_package_installed(id) and (lastest_installable is not None) and (installed_packages[id] != lastest_installable['version']))
-    else:
-        return (is_package_installed(id) and (lastest_installable is not None) and (installed_packages[id] != 'Unknown') and (installed_packages[id] != lastest_installable['version']))
+    installed_version = installed_packages.get(id)
+    if (installed_version is None) or (lastest_installable is None):
+        return False
+    if (installed_version == 'Unknown') and not force:
+        return False
+    return installed_version != lastest_installable['version']
 
 def get_python_package_name(pkg: MutableMapping) -> str:
     if "wheelname" in pkg:
@@ -366,45 +493,108 @@ def find_dist_version(pkg: MutableMapping, path: Optional[str]) -> Optional[str]
     versions.sort(reverse=True)
     return versions[0] if len(versions) > 0 else None
 
+def detect_package_version(p: MutableMapping) -> Optional[str]:
+    if p['type'] == 'PyWheel':
+        return find_dist_version(p, get_install_path(p))
+    version: Optional[str] = None
+    bin_name = get_bin_name(p)
+    dest_prefix: str = install_path_prefixes[p['type']]
+    # releases tend to share file names, so every file is only looked at once; None marks a missing file
+    file_hashes: MutableMapping = {}
+    for v in p['releases']:
+        matched = True
+        exists = True
+        if bin_name in v:
+            for f in v[bin_name]['files']:
+                path = dest_prefix + f
+                if path not in file_hashes:
+                    if not matched:
+                        # the release can no longer match, only find out whether all of its files exist
+                        if not os.path.exists(path):
+                            exists = False
+                            break
+                        continue
+                    try:
+                        file_hashes[path] = get_file_hash(path)
+                    except FileNotFoundError:
+                        file_hashes[path] = None
+                if file_hashes[path] is None:
+                    exists = False
+                    matched = False
+                    break
+                if file_hashes[path] != v[bin_name]['files'][f][1]:
+                    matched = False
+            if matched:
+                return v['version']
+            elif exists:
+                version = 'Unknown'
+    return version
+
 def detect_installed_packages() -> None:
     if package_list is not None:
-        for p in package_list:
-            dest_path = get_install_path(p)
-            if p['type'] == 'PyWheel':
-                version = find_dist_version(p, dest_path)
-                if version is not None:
-                    installed_packages[p['identifier']] = version
-            else:
-                for v in p['releases']:
-                    matched = True
-                    exists = True
-                    bin_name = get_bin_name(p)
-                    if bin_name in v:
-                        for f in v[bin_name]['files']:
-                            try:
-                                with open(os.path.join(dest_path, f), 'rb') as fh:
-                                    if not check_hash(fh.read(), v[bin_name]['files'][f][1])[0]:
-                                        matched = False
-                            except FileNotFoundError:
-                                exists = False
-                                matched = False
-                        if matched:
-                            installed_packages[p['identifier']] = v['version']
-                            break
-                        elif exists:
-                            installed_packages[p['identifier']] = 'Unknown'
+        # hashing releases the GIL, so checking packages concurrently overlaps disk reads and hashing
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1)) as executor:
+            versions = list(executor.map(detect_package_version, package_list))
+        for p, version in zip(package_list, versions):
+            if version is not None:
+                installed_packages[p['identifier']] = version
     else:
         print('No valid package definitions found. Run update command first!')
         sys.exit(1)
 
+installed_state_path = os.path.join(os.path.dirname(package_json_path), 'vsrepo_installed.json')
+
+def installed_state_key() -> MutableMapping:
+    # everything detection depends on besides the package definitions
+    return { 'target': args.target, 'binary_path': os.path.abspath(plugin_path), 'script_path': os.path.abspath(py_script_path), 'site_package_dir': site_package_dir }
+
+def save_installed_packages() -> None:
+    try:
+        with open(installed_state_path, 'w', encoding='utf-8') as sf:
+            json.dump({ **installed_state_key(), 'packages': installed_packages }, sf)
+    except OSError:
+        pass
+
+def remove_installed_state() -> None:
+    try:
+        os.remove(installed_state_path)
+    except FileNotFoundError:
+        pass
+
+def load_installed_packages() -> None:
+    # the saved state is only trusted if it was written for the same target and install paths and isn't older than the package definitions,
+    # updating the definitions removes it
+    if not args.verify:
+        try:
+            if os.path.getmtime(installed_state_path) >= os.path.getmtime(package_json_path):
+                with open(installed_state_path, 'r', encoding='utf-8') as sf:
+                    state = json.load(sf)
+                if isinstance(state, dict) and isinstance(state.get('packages'), dict) and all(state.get(key) == value for key, value in installed_state_key().items()):
+                    installed_packages.update(state['packages'])
+                    return
+        except (OSError, ValueError, KeyError):
+            pass
+    detect_installed_packages()
+    save_installed_packages()
+
+@contextlib.contextmanager
+def recording_installed_state() -> Iterator[None]:
+    try:
+        yield
+    except:
+        # an operation that failed partway may have changed files it never recorded, so let the next run detect them
+        remove_installed_state()
+        raise
+    save_installed_packages()
+
 def print_package_status(p: MutableMapping) -> None:
     lastest_installable = get_latest_installable_release(p)
+    installed_version = installed_packages.get(p['identifier'])
     name = p['name']
-    if is_package_upgradable(p['identifier'], False):
-        name = '*' + name
-    elif is_package_upgradable(p['identifier'], True):
-        name = '+' + name
-    print(package_print_string.format(name, p['namespace'] if p['type'] == 'VSPlugin' else p['modulename'], installed_packages.get(p['identifier'], ""), lastest_installable.get('version') if lastest_installable is not None else '', p['identifier']))
+    # an unknown version is the only thing that needs forcing, so one check covers both markers
+    if is_package_upgradable(p['identifier'], True):
+        name = ('+' if installed_version == 'Unknown' else '*') + name
+    print(package_print_string.format(name, p['namespace'] if p['type'] == 'VSPlugin' else p['modulename'], installed_version if installed_version is not None else '', lastest_installable.get('version') if lastest_installable is not None else '', p['identifier']))
 
 def list_installed_packages() -> None:
     print(package_print_string.format('Name', 'Namespace', 'Installed', 'Latest', 'Identifier'))
@@ -421,7 +611,17 @@ def list_available_packages() -> None:
     for p in package_list:
         print_package_status(p)
 
+latest_installable_cache: MutableMapping = {}
+
 def get_latest_installable_release_with_index(p: MutableMapping) -> Tuple[int, Optional[MutableMapping]]:
+    # the result only depends on the target architecture and the VapourSynth api version, both fixed for this run
+    result = latest_installable_cache.get(p['identifier'])
+    if result is None:
+        result = find_latest_installable_release(p)
+        latest_installable_cache[p['identifier']] = result
+    return result
+
+def find_latest_installable_release(p: MutableMapping) -> Tuple[int, Optional[MutableMapping]]:
     max_api = get_vapoursynth_api_version()
     package_api: int = 3
     if 'api' in p:
@@ -537,6 +737,42 @@ Platform: All""")
             w.writerow([filename, sha256hex, length])
 
 
+def extract_archive_files(archive_path: str, names: List[str]) -> MutableMapping:
+    if zipfile.is_zipfile(archive_path):
+        try:
+            with zipfile.ZipFile(archive_path, 'r') as zf:
+                # 7-zip matches member names case-insensitively and the package definitions rely on that
+                members = {member.casefold(): member for member in zf.namelist()}
+                return {name: zf.read(members.get(name.casefold(), name)) for name in names}
+        except (KeyError, NotImplementedError):
+            # a name zipfile can't resolve or an unsupported compression method, let 7-zip deal with it
+            pass
+
+    tdpath = tempfile.mkdtemp(prefix='vsm')
+    try:
+        extracted_7z = False
+        if ('py7zr' in sys.modules) and py7zr.is_7zfile(archive_path):
+            try:
+                with py7zr.SevenZipFile(archive_path, 'r') as z:
+                    z.extract(path=tdpath, targets=names)
+                extracted_7z = True
+            except py7zr.exceptions.UnsupportedCompressionMethodError:
+                # some filters like BCJ2 aren't supported, let 7-zip deal with it
+                pass
+        if not extracted_7z:
+            result = subprocess.run([cmd7zip_path, "x", "-y", "-o" + tdpath, archive_path, *names], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            result.check_returncode()
+        extracted = {}
+        for name in names:
+            try:
+                with open(os.path.join(tdpath, name), 'rb') as f:
+                    extracted[name] = f.read()
+            except FileNotFoundError:
+                raise Exception('Member ' + name + ' not found in archive') from None
+        return extracted
+    finally:
+        shutil.rmtree(tdpath, ignore_errors=True)
+
 def install_files(p: MutableMapping) -> Tuple[int, int]:
     err = (0, 1)
     dest_path = get_install_path(p)
@@ -545,9 +781,8 @@ def install_files(p: MutableMapping) -> Tuple[int, int]:
     if install_rel is None:
         return err
     url = install_rel[bin_name]['url']
-    data: Optional[bytearray] = None
     try:
-        data = fetch_url_cached(url, p['name'] + ' ' + install_rel['version'])
+        archive_path = fetch_url_cached(url, p['name'] + ' ' + install_rel['version'])
     except:
         print('Failed to download ' + p['name'] + ' ' + install_rel['version'] + ', skipping installation and moving on')
         return err
@@ -556,10 +791,10 @@ def install_files(p: MutableMapping) -> Tuple[int, int]:
 
     if bin_name == 'wheel':
         try:
-            hash_result = check_hash(data, install_rel[bin_name]['hash'])
-            if not hash_result[0]:
-                raise ValueError('Hash mismatch for ' + url + ' got ' + hash_result[1] + ' but expected ' + hash_result[2])
-            with zipfile.ZipFile(io.BytesIO(data), 'r') as zf:
+            archive_hash = hash_file(archive_path)
+            if archive_hash != install_rel[bin_name]['hash']:
+                raise ValueError('Hash mismatch for ' + url + ' got ' + archive_hash + ' but expected ' + install_rel[bin_name]['hash'])
+            with zipfile.ZipFile(archive_path, 'r') as zf:
                 basename: Optional[str] = None
                 for fn in zf.namelist():
                     if fn.endswith('.dist-info/WHEEL'):
@@ -599,34 +834,28 @@ def install_files(p: MutableMapping) -> Tuple[int, int]:
                 single_file = (key, install_rel[bin_name]['files'][key][0], install_rel[bin_name]['files'][key][1])
         if (single_file is not None) and (single_file[1] == url.rsplit('/', 2)[-1]):
             install_fn = single_file[0]
-            hash_result = check_hash(data, single_file[2])
-            if not hash_result[0]:
-                raise Exception('Hash mismatch for ' + install_fn + ' got ' + hash_result[1] + ' but expected ' + hash_result[2])
+            archive_hash = hash_file(archive_path)
+            if archive_hash != single_file[2]:
+                raise Exception('Hash mismatch for ' + install_fn + ' got ' + archive_hash + ' but expected ' + single_file[2])
             uninstall_files(p)
             os.makedirs(os.path.join(dest_path, os.path.split(install_fn)[0]), exist_ok=True)
-            with open(os.path.join(dest_path, install_fn), 'wb') as outfile:
-                files.append((os.path.join(dest_path, install_fn), single_file[2], str(len(data))))
-                outfile.write(data)
+            shutil.copyfile(archive_path, os.path.join(dest_path, install_fn))
+            files.append((os.path.join(dest_path, install_fn), single_file[2], str(os.path.getsize(archive_path))))
         else:
-            tffd, tfpath = tempfile.mkstemp(prefix='vsm')
-            with open(tffd, mode='wb') as tf:
-                tf.write(data)
+            extracted = extract_archive_files(archive_path, [fn_props[0] for fn_props in install_rel[bin_name]['files'].values()])
             result_cache = {}
             for install_fn in install_rel[bin_name]['files']:
                 fn_props = install_rel[bin_name]['files'][install_fn]
-                result = subprocess.run([cmd7zip_path, "e", "-so", tfpath, fn_props[0]], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                result.check_returncode()
-                hash_result = check_hash(result.stdout, fn_props[1])
+                hash_result = check_hash(extracted[fn_props[0]], fn_props[1])
                 if not hash_result[0]:
                     raise Exception('Hash mismatch for ' + install_fn + ' got ' + hash_result[1] + ' but expected ' + hash_result[2])
-                result_cache[install_fn] = (result.stdout, fn_props[1])
+                result_cache[install_fn] = (extracted[fn_props[0]], fn_props[1])
             uninstall_files(p)
             for install_fn in install_rel[bin_name]['files']:
                 os.makedirs(os.path.join(dest_path, os.path.split(install_fn)[0]), exist_ok=True)
                 with open(os.path.join(dest_path, install_fn), 'wb') as outfile:
                     files.append((os.path.join(dest_path, install_fn), str(result_cache[install_fn][1]), str(len(result_cache[install_fn][0]))))
                     outfile.write(result_cache[install_fn][0])
-            os.remove(tfpath)
 
         install_package_meta(files, p, install_rel, idx)
 
@@ -634,8 +863,13 @@ def install_files(p: MutableMapping) -> Tuple[int, int]:
     print('Successfully installed ' + p['name'] + ' ' + install_rel['version'])
     return (1, 0)
 
-def install_package(name: str) -> Tuple[int, int, int]:
+def install_package(name: str, visited: Optional[Set[str]] = None) -> Tuple[int, int, int]:
     p = get_package_from_name(name)
+    # shared dependencies and dependency cycles are only walked once
+    visited = visited if visited is not None else set()
+    if p['identifier'] in visited:
+        return (0, 0, 0)
+    visited.add(p['identifier'])
     if get_vapoursynth_api_version() <= 3:
         if p['identifier'] in bundled_api3_plugins:
             print('Binaries are already bundled for ' + p['name'] + ', skipping installation')
@@ -647,7 +881,7 @@ def install_package(name: str) -> Tuple[int, int, int]:
                 for dep in p['dependencies']:
                     if not isinstance(dep, str):
                         continue
-                    res = install_package(dep)
+                    res = install_package(dep, visited)
                     inst = (inst[0], inst[1] + res[0] + res[1], inst[2] + res[2])
         if not is_package_installed(p['identifier']):
             fres = install_files(p)
@@ -657,13 +891,15 @@ def install_package(name: str) -> Tuple[int, int, int]:
         print('No binaries available for ' + args.target + ' in package ' + p['name'] + ', skipping installation')
         return (0, 0, 1)
 
-def upgrade_files(p: MutableMapping) -> Tuple[int, int, int]:
+def upgrade_files(p: MutableMapping, visited: Optional[Set[str]] = None) -> Tuple[int, int, int]:
+    visited = visited if visited is not None else set()
+    visited.add(p['identifier'])
     if can_install(p):
         inst = (0, 0, 0)
         if 'dependencies' in p:
             for dep in p['dependencies']:
                 if not is_package_installed(dep):
-                    res = install_package(dep)
+                    res = install_package(dep, visited)
                     inst = (inst[0], inst[1] + res[0] + res[1], inst[2] + res[2])
         fres = install_files(p)
         return (inst[0] + fres[0], inst[1], inst[2] + fres[1])
@@ -722,10 +958,7 @@ def uninstall_files(p: MutableMapping) -> None:
     else:
         installed_rel: Optional[MutableMapping] = None
         if p['identifier'] in installed_packages:
-            for rel in p['releases']:
-                if rel['version'] == installed_packages[p['identifier']]:
-                    installed_rel = rel
-                    break
+            installed_rel = package_releases_by_version[p['identifier']].get(installed_packages[p['identifier']])
         if installed_rel is not None:
             for f in installed_rel[bin_name]['files']:
                 os.remove(os.path.join(dest_path, f))
@@ -741,28 +974,50 @@ def uninstall_package(name: str) -> Tuple[int, int]:
         else:
             uninstall_files(p)
             print('Uninstalled package: ' + p['name'] + ' ' + installed_packages[p['identifier']])
+            del installed_packages[p['identifier']]
             return (1, 0)
     else:
         print('No files installed for ' + p['name'] + ', skipping uninstall')
         return (0, 0)
 
+package_etag_path = os.path.splitext(package_json_path)[0] + '.etag.json'
+
 def update_package_definition(url: str) -> None:
     localmtimeval = 0.0
+    localetag: Optional[str] = None
     try:
         localmtimeval = os.path.getmtime(package_json_path)
+        # the etag is only meaningful while the definitions it was sent with still exist
+        with open(package_etag_path, 'r', encoding='utf-8') as ef:
+            localetag = json.load(ef).get('etag')
     except:
         pass
     localmtime = email.utils.formatdate(localmtimeval + 10, usegmt=True)
-    req_obj = urllib.request.Request(url, headers={ 'If-Modified-Since': localmtime, 'User-Agent': 'VSRepo' })
+    headers = { 'If-Modified-Since': localmtime, 'Accept-Encoding': 'gzip', 'User-Agent': 'VSRepo' }
+    if localetag is not None:
+        headers['If-None-Match'] = localetag
+    req_obj = urllib.request.Request(url, headers=headers)
+    tmp_path: Optional[str] = None
     try:
         with urllib.request.urlopen(req_obj) as urlreq:
             remote_modtime = email.utils.mktime_tz(email.utils.parsedate_tz(urlreq.info()['Last-Modified']))
-            data = urlreq.read()
-            with zipfile.ZipFile(io.BytesIO(data), 'r') as zf:
-                with zf.open('vspackages3.json') as pkgfile:
-                    with open(package_json_path, 'wb') as dstfile:
-                        dstfile.write(pkgfile.read())
-                    os.utime(package_json_path, times=(remote_modtime, remote_modtime))
+            remote_etag = urlreq.info()['ETag']
+            with tempfile.NamedTemporaryFile(prefix='vsm', delete=False) as tmp:
+                tmp_path = tmp.name
+                if urlreq.info()['Content-Encoding'] == 'gzip':
+                    with gzip.GzipFile(fileobj=urlreq) as gzreq:
+                        shutil.copyfileobj(gzreq, tmp)
+                else:
+                    shutil.copyfileobj(urlreq, tmp)
+        with zipfile.ZipFile(tmp_path, 'r') as zf:
+            with zf.open('vspackages3.json') as pkgfile:
+                with open(package_json_path, 'wb') as dstfile:
+                    shutil.copyfileobj(pkgfile, dstfile)
+                os.utime(package_json_path, times=(remote_modtime, remote_modtime))
+        # the definitions get the server's modification time which may well be older than the saved state, so drop it outright
+        remove_installed_state()
+        with open(package_etag_path, 'w', encoding='utf-8') as ef:
+            json.dump({'etag': remote_etag}, ef)
     except urllib.error.HTTPError as httperr:
         if httperr.code == 304:
             print('Local definitions already up to date: ' + email.utils.formatdate(localmtimeval, usegmt=True))
@@ -770,6 +1025,9 @@ def update_package_definition(url: str) -> None:
             raise
     else:
         print('Local definitions updated to: ' + email.utils.formatdate(remote_modtime, usegmt=True))
+    finally:
+        if tmp_path is not None:
+            os.remove(tmp_path)
 
 
 def get_vapoursynth_version() -> int:
@@ -853,13 +1111,14 @@ for name in args.package:
         sys.exit(1)
 
 if args.operation == 'install':
-    detect_installed_packages()
+    load_installed_packages()
     rebuild_distinfo()
 
     inst = (0, 0, 0)
-    for name in args.package:
-        res = install_package(name)
-        inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
+    with recording_installed_state():
+        for name in args.package:
+            res = install_package(name)
+            inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
 
     update_genstubs()
 
@@ -874,16 +1133,17 @@ if args.operation == 'install':
     if (inst[2] > 0):
         print('{} {} failed'.format(inst[2], 'package' if inst[0] == 1 else 'packages'))
 elif args.operation in ('upgrade', 'upgrade-all'):
-    detect_installed_packages()
+    load_installed_packages()
     rebuild_distinfo()
 
     inst = (0, 0, 0)
-    if args.operation == 'upgrade-all':
-        inst = upgrade_all_packages(args.force)
-    else:
-        for name in args.package:
-            res = upgrade_package(name, args.force)
-            inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
+    with recording_installed_state():
+        if args.operation == 'upgrade-all':
+            inst = upgrade_all_packages(args.force)
+        else:
+            for name in args.package:
+                res = upgrade_package(name, args.force)
+                inst = (inst[0] + res[0], inst[1] + res[1], inst[2] + res[2])
 
     update_genstubs()
 
@@ -898,21 +1158,22 @@ elif args.operation in ('upgrade', 'upgrade-all'):
     if (inst[2] > 0):
         print('{} {} failed'.format(inst[2], 'package' if inst[0] == 1 else 'packages'))
 elif args.operation == 'uninstall':
-    detect_installed_packages()
+    load_installed_packages()
     uninst = (0, 0)
-    for name in args.package:
-        uninst_res = uninstall_package(name)
-        uninst = (uninst[0] + uninst_res[0], uninst[1] + uninst_res[1])
+    with recording_installed_state():
+        for name in args.package:
+            uninst_res = uninstall_package(name)
+            uninst = (uninst[0] + uninst_res[0], uninst[1] + uninst_res[1])
     if uninst[0] == 0:
         print('No packages uninstalled')
     else:
         print('{} {} uninstalled'.format(uninst[0], 'package' if uninst[0] == 1 else 'packages'))
     update_genstubs()
 elif args.operation == 'installed':
-    detect_installed_packages()
+    load_installed_packages()
     list_installed_packages()
 elif args.operation == 'available':
-    detect_installed_packages()
+    load_installed_packages()
     list_available_packages()
 elif args.operation == 'update':
     update_package_definition('http://www.vapoursynth.com/vsrepo/vspackages3.zip')
@@ -921,7 +1182,7 @@ elif args.operation == 'paths':
 elif args.operation == "genstubs":
     update_genstubs()
 elif args.operation == "gendistinfo":
-    detect_installed_packages()
+    load_installed_packages()
     rebuild_distinfo()
 
 